@@ -40,4 +40,5 @@ are:
     blue green  red
 
 """
+from array2gif.cache import DirectoryCache, MemoryCache
 from array2gif.core import check_dataset, write_gif
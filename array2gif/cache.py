@@ -0,0 +1,165 @@
+"""
+array2gif.cache
+~~~~~~~~~~~~~~~
+
+Optional caches for encoded frames, so that a frame that is identical
+to one encoded in a previous run is spliced into the GIF as bytes
+instead of going through the LZW compression again.
+
+A cache is any object with two methods::
+
+    get(key)           # return the cached bytes, or None
+    set(key, value)    # store the bytes under the (hex string) key
+
+Two backends are provided, both evicting the least recently used
+entries once the total size of the stored values exceeds `max_bytes`:
+
+- `MemoryCache`, a dictionary that lives as long as the process.
+- `DirectoryCache`, one file per frame in a directory on disk, so it
+  can be shared between runs.
+"""
+import os
+import tempfile
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class MemoryCache(object):
+    """In-memory least-recently-used cache of encoded frames."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value  # now the most recently used
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old_value = self._entries.pop(key, None)
+        if old_value is not None:
+            self.size -= len(old_value)
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class DirectoryCache(object):
+    """On-disk least-recently-used cache of encoded frames.
+
+    Each frame is stored in its own file named after its key. The
+    file modification time marks when the frame was last used.
+    """
+
+    SUFFIX = '.gifblock'
+    # Once over `max_bytes`, evict down to this fraction of it, so the
+    # directory is scanned once per many writes rather than every write.
+    LOW_WATER_MARK = 0.75
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size = None  # total size of the entries, once scanned
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def _entries(self):
+        """Return (mtime, size, filename) for each entry, oldest first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return sorted(entries)
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def size(self):
+        """The total size of the entries, kept up to date by `set`.
+
+        The directory is only scanned the first time, so entries
+        written by other processes are counted at the next eviction.
+        """
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        return self._size
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as infile:
+                value = infile.read()
+            os.utime(filename, None)  # now the most recently used
+        except (IOError, OSError):
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        size = self.size
+        filename = self._filename(key)
+        # Write to a temporary file first so a reader never sees
+        # a partially written frame. The cache is only an optimization,
+        # so if the file system or another process gets in the way,
+        # the frame just isn't stored.
+        try:
+            fd, tmp_filename = tempfile.mkstemp(dir=self.path)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(value)
+            try:
+                size -= os.path.getsize(filename)
+                os.remove(filename)
+            except OSError:  # not cached, or removed by another process
+                pass
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            return
+        finally:
+            try:
+                os.remove(tmp_filename)
+            except OSError:  # already renamed
+                pass
+        self._size = size + len(value)
+        if self._size > self.max_bytes:
+            self._evict(keep=filename)
+
+    def _evict(self, keep):
+        entries = self._entries()
+        size = sum(size for _, size, _ in entries)
+        target = self.LOW_WATER_MARK * self.max_bytes
+        for _, entry_size, filename in entries:
+            if size <= target:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
@@ -12,10 +12,12 @@ which was made understandable by Matthew Flickinger's blog:
 http://www.matthewflickinger.com/lab/whatsinagif/bits_and_bytes.asp
 """
 from __future__ import division
+import hashlib
 import math
 import struct
 import warnings
 from collections import Counter
+from itertools import chain, islice
 
 import numpy
 
@@ -31,6 +33,7 @@ warnings.filterwarnings('default', module=__name__, message='.*')
 BLOCK_TERMINATOR = b'\x00'
 EXTENSION = b'\x21'
 HEADER = b'GIF89a'
+MIN_DELAY_TIME = 2
 TRAILER = b'\x3b'
 ZERO = b'\x00'
 
@@ -95,17 +98,124 @@ def try_fix_dataset(dataset):
     return dataset
 
 
-def get_image(dataset):
-    """Convert the NumPy array to two nested lists with r,g,b tuples."""
-    dim, nrow, ncol = dataset.shape
+def _get_spatial_axes(array):
+    """Return the (rows, cols) axes of an rgb or PIL ordered array."""
+    if len(array.shape) == 3:
+        if array.shape[0] == 3:  # rgb x rows x cols
+            return 1, 2
+        elif array.shape[-1] == 3:  # PIL rows x cols x rgb
+            return 0, 1
+    elif len(array.shape) == 4:
+        if array.shape[1] == 3:
+            return 2, 3
+        elif array.shape[-1] == 3:
+            return 1, 2
+    return None
+
+
+def get_scale_factor(nrows, ncols, scale=None, max_size=None):
+    """Return the integer factor to shrink an image's rows and cols by.
+
+    :param scale: Shrink by this whole number (e.g. 4 turns every
+                  4 x 4 block of pixels into one pixel).
+    :param max_size: Shrink until neither the width nor the height
+                     is larger than this many pixels.
+    """
+    factor = 1
+    if scale is not None:
+        if int(scale) != scale or scale < 1:
+            raise ValueError('The scale must be a whole number, at least 1.')
+        factor = int(scale)
+    if max_size is not None:
+        if max_size < 1:
+            raise ValueError('The max_size must be at least 1 pixel.')
+        factor = max(factor, int(math.ceil(max(nrows, ncols) / max_size)))
+    return factor
+
+
+def _downscale_array(array, factor, resample):
+    axes = _get_spatial_axes(array)
+    if axes is None or factor == 1:
+        return array  # leave it for `check_dataset` to complain about
+    if resample == 'nearest':
+        index = [slice(None)] * len(array.shape)
+        for axis in axes:
+            index[axis] = slice(None, None, factor)
+        return array[tuple(index)]
+    # Block average; the last block along each axis may be partial.
+    summed = array.astype('float64')
+    counts = numpy.ones([1] * len(array.shape))
+    for axis in axes:
+        starts = numpy.arange(0, array.shape[axis], factor)
+        summed = numpy.add.reduceat(summed, starts, axis=axis)
+        sizes = numpy.diff(numpy.append(starts, array.shape[axis]))
+        sizes_shape = [1] * len(array.shape)
+        sizes_shape[axis] = len(sizes)
+        counts = counts * sizes.reshape(sizes_shape)
+    return numpy.rint(summed / counts).astype(array.dtype)
+
+
+def downscale_dataset(dataset, scale=None, max_size=None, resample='nearest'):
+    """Shrink the image(s) by a whole number factor, before any encoding.
+
+    Works on the same datasets as `write_gif`: a 3D or 4D NumPy array,
+    or a list of 3D arrays, in rgb or PIL ordering.
+
+    :param scale: Shrink by this whole number factor.
+    :param max_size: Shrink until the width and height are at most
+                     this many pixels.
+    :param resample: 'nearest' keeps every `scale`-th pixel, so no new
+                     colors are made. 'mean' averages each block of
+                     pixels, which looks smoother but can add colors.
+    """
+    if resample not in ('nearest', 'mean'):
+        raise ValueError("The resample method must be 'nearest' or 'mean'.")
+
+    def downscale(array):
+        if not isinstance(array, numpy.ndarray):
+            return array
+        axes = _get_spatial_axes(array)
+        if axes is None:
+            return array
+        nrows, ncols = (array.shape[axis] for axis in axes)
+        factor = get_scale_factor(nrows, ncols, scale, max_size)
+        return _downscale_array(array, factor, resample)
+
+    if isinstance(dataset, numpy.ndarray):
+        return downscale(dataset)
+    return [downscale(d) for d in dataset]
+
+
+def _get_uint8_dataset(dataset, warn=True):
+    """Cast to `uint8`, warning if that changes any values."""
     uint8_dataset = dataset.astype('uint8')
-    if not (uint8_dataset == dataset).all():
+    if warn and not (uint8_dataset == dataset).all():
         message = (
             "\nYour image was cast to a `uint8` (`<img>.astype(uint8)`), "
             "but some information was lost.\nPlease check your gif and "
             "convert to uint8 beforehand if the gif looks wrong."
         )
         warnings.warn(message)
+    return uint8_dataset
+
+
+def _get_pixel_codes(dataset, warn=True):
+    """Return a rows x cols array with each pixel's color as 0xRRGGBB."""
+    uint8_dataset = _get_uint8_dataset(dataset, warn=warn)
+    codes = uint8_dataset[0].astype('uint32') << 16
+    codes |= uint8_dataset[1].astype('uint32') << 8
+    codes |= uint8_dataset[2]
+    return codes
+
+
+def _get_color(code):
+    return struct.pack('>I', int(code))[1:]
+
+
+def get_image(dataset):
+    """Convert the NumPy array to two nested lists with r,g,b tuples."""
+    dim, nrow, ncol = dataset.shape
+    uint8_dataset = _get_uint8_dataset(dataset)
     image = [[
             struct.pack(
                 'BBB',
@@ -125,10 +235,19 @@ def get_color_table_size(num_colors):
     The result is a three-bit value (represented as a string with
     ones or zeros) that will become part of a packed byte encoding
     various details about the color table, used in the Logical
-    Screen Descriptor block.
+    Screen Descriptor block. The smallest table has two colors.
     """
-    nbits = max(math.ceil(math.log(num_colors, 2)), 2)
-    return '{:03b}'.format(int(nbits - 1))
+    nbits = max((num_colors - 1).bit_length(), 1)
+    return '{:03b}'.format(nbits - 1)
+
+
+def get_lzw_code_size(num_colors):
+    """Return the LZW minimum code size for indices up to `num_colors`.
+
+    This is independent of the color table size, except that the
+    GIF 89a format doesn't allow a minimum code size below 2.
+    """
+    return max((num_colors - 1).bit_length(), 2)
 
 
 def _get_logical_screen_descriptor(image, colors):
@@ -177,16 +296,142 @@ def get_colors(image):
     return colors
 
 
+def get_dataset_colors(dataset):
+    """Return the same Counter as `get_colors(get_image(dataset))`.
+
+    This works on the NumPy array directly, so unlike `get_image`
+    it doesn't make a Python object for every pixel.
+    """
+    codes = _get_pixel_codes(dataset).ravel()
+    unique_codes, first_positions, counts = numpy.unique(
+        codes, return_index=True, return_counts=True)
+    if len(unique_codes) > 256:
+        msg = (
+            "The maximum number of distinct colors in a GIF is 256 but "
+            "this image has {} colors and can't be encoded properly."
+        )
+        raise RuntimeError(msg.format(len(unique_codes)))
+    # Colors in order of first appearance, like `get_colors`, so
+    # that ties in `Counter.most_common` are broken the same way.
+    colors = Counter()
+    for i in numpy.argsort(first_positions, kind='mergesort'):
+        colors[_get_color(unique_codes[i])] = int(counts[i])
+    return colors
+
+
+def get_indices(dataset, colors):
+    """Return a rows x cols `uint8` array of each pixel's color index.
+
+    :param dataset: A NumPy array, rgb x rows x cols.
+    :param colors: The colors, as accepted by `get_palette`. Every
+                   color in the dataset must be in it.
+    """
+    palette_codes = numpy.array(
+        [struct.unpack('>I', b'\x00' + c)[0] for c in get_palette(colors)],
+        dtype='uint32')
+    order = numpy.argsort(palette_codes)
+    positions = numpy.searchsorted(
+        palette_codes[order], _get_pixel_codes(dataset, warn=False))
+    return order.astype('uint8')[positions]
+
+
+def get_palette(colors):
+    """Return the colors in color table order.
+
+    `colors` is either a Counter, in which case the colors are
+    in descending order of count, or a sequence already in order
+    (e.g. from `plan_palette`).
+    """
+    if hasattr(colors, 'most_common'):
+        return [c[0] for c in colors.most_common()]
+    return list(colors)
+
+
+def plan_palette(color_sets):
+    """Order the colors of an animation to shorten the LZW codes.
+
+    Every frame shares the global color table, but each frame's LZW
+    minimum code size only has to cover the highest color index that
+    frame actually uses. So colors used in many frames go first, then
+    (as before) the most common colors. A frame that only uses a few
+    of the animation's colors then gets short codes, which are faster
+    to encode and to decode.
+
+    :param color_sets: A Counter of colors for each frame.
+    :return: The list of distinct colors, in color table order.
+
+    ..raises:: RuntimeError if there are more than 256 colors in total.
+    """
+    colors = Counter()
+    frames_per_color = Counter()
+    for color_set in color_sets:
+        colors += color_set
+        frames_per_color.update(color_set.keys())
+    if len(colors) > 256:
+        msg = (
+            "The maximum number of distinct colors in a GIF is 256.\n"
+            "Although each image has fewer than 256 colors, this library\n"
+            "has not yet implemented the Local Color Table option, meaning\n"
+            "the overall number of distinct colors in the animation has to\n"
+            "be below 256 for now.\n"
+            "This animation has {} distinct colors total...sorry."
+        )
+        raise RuntimeError(msg.format(len(colors)))
+    # Sorting is stable, so ties stay in descending order of count.
+    return sorted(get_palette(colors), key=lambda c: -frames_per_color[c])
+
+
 def _get_global_color_table(colors):
-    """Return a color table sorted in descending order of count.
+    """Return a color table in the order given by `get_palette`.
     """
-    global_color_table = b''.join(c[0] for c in colors.most_common())
+    colors = get_palette(colors)
+    global_color_table = b''.join(colors)
     full_table_size = 2**(1+int(get_color_table_size(len(colors)), 2))
     repeats = 3 * (full_table_size - len(colors))
     zeros = struct.pack('<{}x'.format(repeats))
     return global_color_table + zeros
 
 
+def get_palette_report(dataset):
+    """Report how the palette choices affect the encoded size, in bytes.
+
+    Compares `plan_palette` and the per-frame LZW code sizes against
+    a color table in descending order of count, at least four colors
+    long, with one LZW code size for every frame.
+
+    :param dataset: A NumPy array or list of arrays, as for `write_gif`
+                    (but already in rgb x rows x cols order).
+    :return: A dict with the number of colors, the LZW minimum code
+             sizes, and the color table and image data sizes, each
+             also with a 'baseline_' value for comparison.
+    """
+    if isinstance(dataset, numpy.ndarray) and len(dataset.shape) == 3:
+        dataset = [dataset]
+    color_sets = [get_dataset_colors(d) for d in dataset]
+    palette = plan_palette(color_sets)
+    baseline_colors = sum(color_sets, Counter())
+    baseline_code_size = get_lzw_code_size(len(palette))
+    encoder = FrameEncoder()
+    image_data = [
+        _get_image_data(get_indices(d, palette), palette, encoder=encoder)
+        for d in dataset]
+    baseline_image_data = [
+        _get_image_data(
+            get_indices(d, baseline_colors), baseline_colors,
+            baseline_code_size, encoder=encoder)
+        for d in dataset]
+    return {
+        'colors': len(palette),
+        'lzw_code_sizes': [bytearray(data[:1])[0] for data in image_data],
+        'baseline_lzw_code_size': baseline_code_size,
+        'color_table_bytes': len(_get_global_color_table(palette)),
+        'baseline_color_table_bytes': 3 * 2**baseline_code_size,
+        'image_data_bytes': sum(len(data) for data in image_data),
+        'baseline_image_data_bytes': sum(
+            len(data) for data in baseline_image_data),
+    }
+
+
 # ------------------------------- Graphics Control Extension --- #
 def _get_graphics_control_extension(delay_time=0):
     control_label = b'\xf9'
@@ -216,6 +461,62 @@ def _get_graphics_control_extension(delay_time=0):
     return graphics_control_extension
 
 
+def get_delay_times(num_frames, fps=10, durations=None):
+    """Return the per-frame delay times, in hundredths of a second.
+
+    The GIF format only stores whole centiseconds, so the delays are
+    taken from the rounded cumulative display time of each frame.
+    The rounding error is carried forward to the next frame rather
+    than dropped, so the total runtime of the animation matches the
+    source (e.g. 30 fps becomes 3, 4, 3, 3, 4, 3, ... centiseconds).
+
+    Browsers play a delay of 0 or 1 centisecond as 10, so no frame
+    is shorter than `MIN_DELAY_TIME`; any extra time is taken back
+    from later, longer frames. If that isn't possible (e.g. faster
+    than 50 fps) a warning says the animation will run long.
+
+    :param num_frames: The number of frames in the animation.
+    :param fps: The frames/second of the animation, used when no
+                `durations` are given. May be fractional.
+    :param durations: Optional sequence of per-frame display times,
+                      in seconds, one per frame.
+    """
+    if durations is None:
+        fps = float(fps)
+        if fps <= 0:
+            raise ValueError('The frames/second must be positive.')
+        durations = [1 / fps] * num_frames
+    durations = list(durations)
+    if len(durations) != num_frames:
+        raise ValueError(
+            'There are {} durations but {} frames.'
+            .format(len(durations), num_frames)
+        )
+    if any(d < 0 for d in durations):
+        raise ValueError('Frame durations cannot be negative.')
+    delay_times = []
+    elapsed = 0
+    previous_stop = 0
+    for duration in durations:
+        elapsed += duration
+        stop = int(math.floor(100 * elapsed + 0.5))
+        delay_time = max(stop - previous_stop, MIN_DELAY_TIME)
+        if delay_time > 65535:
+            raise ValueError(
+                'A GIF frame can be displayed at most 655.35 seconds.')
+        delay_times.append(delay_time)
+        previous_stop += delay_time
+    if previous_stop > int(math.floor(100 * elapsed + 0.5)):
+        message = (
+            "\nSome frames are shorter than the {} centisecond minimum "
+            "that browsers play correctly, so the animation will run "
+            "{:.2f} seconds instead of {:.2f} seconds."
+        )
+        warnings.warn(
+            message.format(MIN_DELAY_TIME, previous_stop / 100, elapsed))
+    return delay_times
+
+
 # ----------------------------------- Application Extension --- #
 def _get_application_extension(loop_times=0):
     ANIMATION_LABEL = b'\xff'
@@ -271,80 +572,165 @@ def _get_image_descriptor(image, left=0, top=0):
 
 
 # --------------------------------------------- Image Data --- #
-def _lzw_encode(image, colors):
+class FrameEncoder(object):
+    """LZW compression of the image data, as described by Matthew Flickinger.
+
+    http://www.matthewflickinger.com/lab/whatsinagif/lzw_image_data.asp
+
+    The encoder owns two scratch buffers -- the color index of each
+    pixel and the output bytes -- and reuses them for every frame it
+    encodes. They are sized on the first frame and only grow if a later
+    frame is bigger. The LZW code table is a dictionary rebuilt for each
+    frame (and whenever it fills up); it never has more than 4096
+    entries, well under 1 MB whatever the frame size.
+
+    The encoder's own peak memory is O(frame size): one byte per pixel
+    for the indices, at most `max_output_size(num_pixels)` (about 1.5
+    bytes per pixel) for the output, and the larger of the code table
+    and the returned copy of the output (the table is freed before the
+    copy is made). `write_gif` passes it one frame of color
+    indices at a time (see `get_indices`), so its peak memory doesn't
+    grow with the number of frames either.
+    """
+
     MAX_COMPRESSION_CODE = 4095
-    base_lookup = dict((c[0], i) for i, c in enumerate(colors.most_common()))
-    lookup = base_lookup.copy()
-    lzw_code_size = int(get_color_table_size(len(colors)), 2) + 1
-    clear_code = 2**lzw_code_size
-    end_code = clear_code + 1
-    next_compression_code = end_code
-    # Get the minimum number of bits needed for the next code.
-    nbits = next_compression_code.bit_length()
-    pixel_stream = [pixel for row in image for pixel in row]
-    pixel_buffer = [pixel_stream.pop(0)]
-    coded_bits = [(clear_code, nbits)]
-    for pixel in pixel_stream:
-        test_string = b''.join(pixel_buffer) + pixel
-        if test_string in lookup:
-            pixel_buffer.append(pixel)
-        elif next_compression_code >= MAX_COMPRESSION_CODE:
-            coded_bits.insert(0, (lookup[b''.join(pixel_buffer)], nbits))
-            coded_bits.insert(0, (clear_code, nbits))
-            pixel_buffer = [pixel]
-            next_compression_code = end_code
-            nbits = next_compression_code.bit_length()
-            lookup = base_lookup.copy()
+
+    def __init__(self):
+        self._indices = bytearray()
+        self._output = bytearray()
+        # State of the bit packing into `_output`.
+        self._bits = 0
+        self._nbits = 0
+        self._position = 0
+        self._block_start = 0
+
+    @staticmethod
+    def max_output_size(num_pixels):
+        """Return the most bytes the image data can take.
+
+        Every pixel adds at most one 12-bit code. On top of that are
+        the clear and end codes, one more clear code every time the
+        table fills (after at least 3838 codes), the code size byte,
+        and a length byte for each block of up to 255 bytes.
+        """
+        max_codes = num_pixels + num_pixels // 1024 + 3
+        data_size = (12 * max_codes + 7) // 8
+        return 1 + data_size + data_size // 255 + 1
+
+    def _reserve(self, num_pixels):
+        if len(self._indices) < num_pixels:
+            self._indices = bytearray(num_pixels)
+        output_size = self.max_output_size(num_pixels)
+        if len(self._output) < output_size:
+            self._output = bytearray(output_size)
+
+    def _write_code(self, code, nbits):
+        """Pack the code, least significant bit first, into 255 byte blocks.
+        """
+        self._bits |= code << self._nbits
+        self._nbits += nbits
+        while self._nbits >= 8:
+            self._write_byte(self._bits & 0xff)
+            self._bits >>= 8
+            self._nbits -= 8
+
+    def _write_byte(self, value):
+        self._output[self._position] = value
+        self._position += 1
+        if self._position - self._block_start > 255:
+            self._output[self._block_start] = 255
+            self._block_start = self._position
+            self._position += 1  # leave room for the next block length
+
+    def encode(self, image, colors, lzw_code_size=None):
+        """Return the image data block (without the block terminator).
+
+        :param image: The image, either as returned by `get_image`, or
+                      as a rows x cols array of color indices, as
+                      returned by `get_indices`.
+        :param colors: The colors, as accepted by `get_palette`.
+        :param lzw_code_size: The LZW minimum code size. By default the
+                              smallest one that covers every color index
+                              in this image.
+        """
+        num_pixels = len(image) * len(image[0])
+        self._reserve(num_pixels)
+        indices = self._indices
+        if isinstance(image, numpy.ndarray):
+            numpy.frombuffer(indices, dtype='uint8', count=num_pixels)[:] = (
+                image.ravel())
+            max_index = int(image.max())
         else:
-            code = lookup[b''.join(pixel_buffer)]
-            coded_bits.insert(0, (code, nbits))
-            pixel_buffer = [pixel]
-            next_compression_code += 1
-            nbits = next_compression_code.bit_length()
-            lookup[test_string] = next_compression_code
-    # Add the last content from the pixel buffer.
-    coded_bits.insert(0, (lookup[b''.join(pixel_buffer)], nbits))
-    coded_bits.insert(0, (end_code, nbits))
-    return lzw_code_size, coded_bits
-
-
-def _get_image_data(image, colors):
-    """Performs the LZW compression as described by Matthew Flickinger.
-
-    This isn't fast, but it works.
-    http://www.matthewflickinger.com/lab/whatsinagif/lzw_image_data.asp
+            lookup = dict((c, i) for i, c in enumerate(get_palette(colors)))
+            position = 0
+            for row in image:
+                for pixel in row:
+                    indices[position] = lookup[pixel]
+                    position += 1
+            max_index = max(islice(indices, num_pixels))
+        if lzw_code_size is None:
+            lzw_code_size = get_lzw_code_size(max_index + 1)
+        clear_code = 2**lzw_code_size
+        end_code = clear_code + 1
+        next_compression_code = end_code
+        # Get the minimum number of bits needed for the next code.
+        nbits = next_compression_code.bit_length()
+        # Codes for strings of more than one pixel, keyed by the code
+        # for all but the last pixel and the last pixel's color index.
+        table = {}
+        self._output[0] = lzw_code_size
+        self._bits = self._nbits = 0
+        self._block_start = 1
+        self._position = 2
+        self._write_code(clear_code, nbits)
+        prefix = indices[0]
+        for index in islice(indices, 1, num_pixels):
+            key = (prefix << 8) | index
+            code = table.get(key)
+            if code is not None:
+                prefix = code
+            elif next_compression_code >= self.MAX_COMPRESSION_CODE:
+                self._write_code(prefix, nbits)
+                self._write_code(clear_code, nbits)
+                prefix = index
+                next_compression_code = end_code
+                nbits = next_compression_code.bit_length()
+                table.clear()
+            else:
+                self._write_code(prefix, nbits)
+                prefix = index
+                next_compression_code += 1
+                nbits = next_compression_code.bit_length()
+                table[key] = next_compression_code
+        # Add the last content from the pixel buffer.
+        self._write_code(prefix, nbits)
+        self._write_code(end_code, nbits)
+        table.clear()  # free it before copying out the output
+        if self._nbits > 0:
+            self._write_byte(self._bits)
+        # Close the last block, dropping it if it's empty.
+        block_length = self._position - self._block_start - 1
+        if block_length > 0:
+            self._output[self._block_start] = block_length
+        else:
+            self._position = self._block_start
+        return memoryview(self._output)[:self._position].tobytes()
+
+
+def _get_image_data(image, colors, lzw_code_size=None, encoder=None):
+    """Performs the LZW compression, with a new `FrameEncoder` by default.
     """
-    lzw_code_size, coded_bits = _lzw_encode(image, colors)
-    coded_bytes = ''.join(
-        '{{:0{}b}}'.format(nbits).format(val) for val, nbits in coded_bits)
-    coded_bytes = '0' * ((8 - len(coded_bytes)) % 8) + coded_bytes
-    coded_data = list(
-        reversed([
-            int(coded_bytes[8*i:8*(i+1)], 2)
-            for i in range(len(coded_bytes) // 8)
-        ])
-    )
-    output = [struct.pack('<B', lzw_code_size)]
-    # Must output the data in blocks of length 255
-    block_length = min(255, len(coded_data))
-    while block_length > 0:
-        block = struct.pack(
-            '<{}B'.format(block_length + 1),
-            block_length,
-            *coded_data[:block_length]
-        )
-        output.append(block)
-        coded_data = coded_data[block_length:]
-        block_length = min(255, len(coded_data))
-    return b''.join(output)
+    if encoder is None:
+        encoder = FrameEncoder()
+    return encoder.encode(image, colors, lzw_code_size)
 
 
-def _get_sub_image(image, colors, delay_time=0):
+def _get_sub_image(image, colors, delay_time=0, encoder=None):
     graphics_control_extension = (
         _get_graphics_control_extension(delay_time=delay_time)
     )
     image_descriptor = _get_image_descriptor(image)
-    image_data = _get_image_data(image, colors)
+    image_data = _get_image_data(image, colors, encoder=encoder)
     return b''.join((
         graphics_control_extension,
         image_descriptor,
@@ -352,38 +738,75 @@ def _get_sub_image(image, colors, delay_time=0):
         BLOCK_TERMINATOR))
 
 
-def _make_gif(dataset):
-    image = get_image(dataset)
-    colors = get_colors(image)
+def get_frame_key(image, colors, delay_time=0):
+    """Return a hex digest identifying the encoded sub-image block.
+
+    The key covers everything `_get_sub_image` depends on: the
+    library version, the encoding options, the palette, and the
+    color index of every pixel (or, for an image from `get_image`,
+    the pixels themselves, which given the palette are the same).
+    """
+    digest = hashlib.sha1()
+    digest.update(
+        '{}:{}x{}:{}:'.format(
+            __version__, len(image[0]), len(image), delay_time
+        ).encode('ascii')
+    )
+    digest.update(_get_global_color_table(colors))
+    if isinstance(image, numpy.ndarray):
+        digest.update(b'indices:')
+        digest.update(numpy.ascontiguousarray(image, dtype='uint8').data)
+    else:
+        for row in image:
+            digest.update(b''.join(row))
+    return digest.hexdigest()
+
+
+def _get_cached_sub_image(image, colors, delay_time=0, cache=None,
+                          encoder=None):
+    """Return `_get_sub_image`, reusing previously encoded bytes if cached.
+    """
+    if cache is None:
+        return _get_sub_image(
+            image, colors, delay_time=delay_time, encoder=encoder)
+    key = get_frame_key(image, colors, delay_time=delay_time)
+    sub_image = cache.get(key)
+    if sub_image is None:
+        sub_image = _get_sub_image(
+            image, colors, delay_time=delay_time, encoder=encoder)
+        cache.set(key, sub_image)
+    return sub_image
+
+
+def _make_gif(dataset, cache=None):
+    colors = get_dataset_colors(dataset)
+    image = get_indices(dataset, colors)
     yield _get_logical_screen_descriptor(image, colors)
     yield _get_global_color_table(colors)
-    yield _get_sub_image(image, colors)
+    yield _get_cached_sub_image(image, colors, cache=cache)
 
 
-def _make_animated_gif(datasets, delay_time=10):
-    images = [get_image(d) for d in datasets]
-    color_sets = (get_colors(image) for image in images)
-    colors = Counter()
-    for color_set in color_sets:
-        colors += color_set
-    if len(colors) > 256:
-        msg = (
-            "The maximum number of distinct colors in a GIF is 256.\n"
-            "Although each image has fewer than 256 colors, this library\n"
-            "has not yet implemented the Local Color Table option, meaning\n"
-            "the overall number of distinct colors in the animation has to\n"
-            "be below 256 for now.\n"
-            "This animation has {} distinct colors total...sorry."
-        )
-        raise RuntimeError(msg.format(len(colors)))
-    yield _get_logical_screen_descriptor(images[0], colors)
+def _make_animated_gif(datasets, delay_times=None, loop=0, cache=None):
+    # Only one frame's pixels are converted at a time, so memory use
+    # doesn't grow with the number of frames.
+    colors = plan_palette(get_dataset_colors(d) for d in datasets)
+    images = (get_indices(d, colors) for d in datasets)
+    first_image = next(images)
+    yield _get_logical_screen_descriptor(first_image, colors)
     yield _get_global_color_table(colors)
-    yield _get_application_extension()
-    for image in images:
-        yield _get_sub_image(image, colors, delay_time=delay_time)
-
-
-def write_gif(dataset, filename, fps=10):
+    if loop is not None:
+        yield _get_application_extension(loop_times=loop)
+    if delay_times is None:
+        delay_times = [10] * len(datasets)
+    encoder = FrameEncoder()  # reuses its buffers for every frame
+    for image, delay_time in zip(chain([first_image], images), delay_times):
+        yield _get_cached_sub_image(
+            image, colors, delay_time=delay_time, cache=cache,
+            encoder=encoder)
+
+
+def write_gif(dataset, filename, fps=10, durations=None, loop=0,
+              cache=None, scale=None, max_size=None, resample='nearest'):
     """Write a NumPy array to GIF 89a format.
 
     Or write a list of NumPy arrays to an animation (GIF 89a format).
@@ -393,7 +816,23 @@ def write_gif(dataset, filename, fps=10):
         :param dataset: A NumPy arrayor list of arrays with shape
                         rgb x rows x cols and integer values in [0, 255].
         :param filename: The output file that will contain the GIF image.
-        :param fps: The (integer) frames/second of the animation (default 10).
+        :param fps: The frames/second of the animation (default 10).
+        :param durations: Optional per-frame display times in seconds,
+                          one per frame. Overrides `fps` when given.
+                          Only for animations.
+        :param loop: How many times the animation repeats; 0 (the
+                     default) repeats forever and None plays it once.
+                     Ignored for a still image.
+        :param cache: Optional cache of encoded frames, such as
+                      `array2gif.cache.MemoryCache` or
+                      `array2gif.cache.DirectoryCache`. Frames already
+                      in the cache skip the LZW compression.
+        :param scale: Optional whole number to shrink the image(s) by,
+                      e.g. for a preview or thumbnail.
+        :param max_size: Optional largest width or height, in pixels,
+                         of the output; the image(s) shrink to fit.
+        :param resample: How to shrink: 'nearest' (the default) or
+                         'mean'. See `downscale_dataset`.
         :type dataset: a NumPy array or list of NumPy arrays.
         :return: None
 
@@ -405,19 +844,32 @@ def write_gif(dataset, filename, fps=10):
 
     ..raises:: ValueError
     """
+    if scale is not None or max_size is not None:
+        dataset = downscale_dataset(dataset, scale, max_size, resample)
     try:
         check_dataset(dataset)
     except ValueError as e:
         dataset = try_fix_dataset(dataset)
         check_dataset(dataset)
-    delay_time = 100 // int(fps)
+    # Check the options before opening (and truncating) the file.
+    if loop is not None:
+        if int(loop) != loop or not 0 <= loop <= 65535:
+            raise ValueError(
+                'The loop count must be a whole number in [0, 65535].')
+        loop = int(loop)
+    four_d = isinstance(dataset, numpy.ndarray) and len(dataset.shape) == 4
+    animated = four_d or not isinstance(dataset, numpy.ndarray)
+    if animated:
+        delay_times = get_delay_times(len(dataset), fps, durations)
+    elif durations is not None:
+        raise ValueError('Durations can only be given for an animation.')
 
     def encode(d):
-        four_d = isinstance(dataset, numpy.ndarray) and len(dataset.shape) == 4
-        if four_d or not isinstance(dataset, numpy.ndarray):
-            return _make_animated_gif(d, delay_time=delay_time)
+        if animated:
+            return _make_animated_gif(
+                d, delay_times=delay_times, loop=loop, cache=cache)
         else:
-            return _make_gif(d)
+            return _make_gif(d, cache=cache)
 
     with open(filename, 'wb') as outfile:
         outfile.write(HEADER)
@@ -3,9 +3,16 @@
 """Tests for array2gif."""
 
 import os
+import shutil
+import tempfile
 import unittest
 import warnings
 import numpy as np
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+import array2gif.cache as cache
 import array2gif.core as core
 from collections import Counter
 
@@ -148,8 +155,15 @@ class Array2GIFTestCase(unittest.TestCase):
         self.assertEqual(img[0][0], b'\x01\x02\x03')
 
     def test_min_color_table_size_is_two(self):
-        binary_string_table_size = core.get_color_table_size(2)
-        self.assertEqual(int(binary_string_table_size, base=2), 1)
+        for num_colors in (1, 2):
+            binary_string_table_size = core.get_color_table_size(num_colors)
+            self.assertEqual(int(binary_string_table_size, base=2), 0)
+
+    def test_min_lzw_code_size_is_two(self):
+        self.assertEqual(core.get_lzw_code_size(1), 2)
+        self.assertEqual(core.get_lzw_code_size(4), 2)
+        self.assertEqual(core.get_lzw_code_size(5), 3)
+        self.assertEqual(core.get_lzw_code_size(256), 8)
 
     def test_color_table_size(self):
         binary_string_table_size = core.get_color_table_size(15)
@@ -185,6 +199,120 @@ class Array2GIFTestCase(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             [y for y in core._make_animated_gif(d)]  # drain the iterator
 
+    def test_delay_times_from_integer_fps(self):
+        self.assertEqual(core.get_delay_times(3, fps=10), [10, 10, 10])
+
+    def test_delay_times_carry_rounding_error(self):
+        delay_times = core.get_delay_times(30, fps=30)
+        self.assertEqual(delay_times[:3], [3, 4, 3])
+        self.assertEqual(sum(delay_times), 100)
+
+    def test_delay_times_from_durations(self):
+        delay_times = core.get_delay_times(3, durations=[0.5, 0.125, 0.125])
+        self.assertEqual(delay_times, [50, 13, 12])
+
+    def test_delay_times_error_when_durations_mismatch_frames(self):
+        with self.assertRaises(ValueError):
+            core.get_delay_times(3, durations=[0.1, 0.1])
+
+    def test_delay_times_error_when_fps_not_positive(self):
+        with self.assertRaises(ValueError):
+            core.get_delay_times(3, fps=0)
+
+    def test_delay_times_from_string_fps(self):
+        self.assertEqual(core.get_delay_times(2, fps='10'), [10, 10])
+        self.assertEqual(core.get_delay_times(3, fps='12.5'), [8, 8, 8])
+
+    def test_delay_times_at_least_two_centiseconds(self):
+        with warnings.catch_warnings(record=True) as wlist:
+            warnings.simplefilter('always')
+            delay_times = core.get_delay_times(6, fps=60)
+            self.assertEqual(delay_times, [2] * 6)
+            self.assertEqual(len(wlist), 1)
+
+    def test_delay_times_short_frames_taken_back_from_later_frames(self):
+        with warnings.catch_warnings(record=True) as wlist:
+            warnings.simplefilter('always')
+            delay_times = core.get_delay_times(
+                3, durations=[0.004, 0.004, 0.5])
+            self.assertEqual(delay_times, [2, 2, 47])
+            self.assertEqual(len(wlist), 0)
+
+    def test_bad_durations_leave_existing_file_alone(self):
+        with open(self.filename, 'wb') as outfile:
+            outfile.write(b'original')
+        dataset = self.flickinger_dataset
+        with self.assertRaises(ValueError):
+            core.write_gif([dataset, dataset], self.filename, durations=[1])
+        with self.assertRaises(ValueError):
+            core.write_gif([dataset, dataset], self.filename, fps=0)
+        with self.assertRaises(ValueError):
+            core.write_gif([dataset, dataset], self.filename, loop=2.5)
+        with self.assertRaises(ValueError):
+            core.write_gif([dataset, dataset], self.filename, loop=-1)
+        with self.assertRaises(ValueError):
+            core.write_gif(dataset, self.filename, durations=[1])
+        with open(self.filename, 'rb') as infile:
+            self.assertEqual(infile.read(), b'original')
+
+    def test_application_extension_loop_count(self):
+        self.assertEqual(
+            core._get_application_extension(loop_times=3),
+            b'!\xff\x0bNETSCAPE2.0\x03\x01\x03\x00\x00'
+        )
+
+    def test_two_color_table(self):
+        colors = Counter({b'\xff\xff\xff': 3, b'\x00\x00\x00': 1})
+        self.assertEqual(
+            core._get_global_color_table(colors),
+            b'\xff\xff\xff\x00\x00\x00'
+        )
+
+    def test_plan_palette_puts_colors_shared_by_frames_first(self):
+        red, green, blue = b'\xff\x00\x00', b'\x00\xff\x00', b'\x00\x00\xff'
+        color_sets = [
+            Counter({red: 90, green: 10}),
+            Counter({red: 50, blue: 50}),
+            Counter({red: 60, blue: 40}),
+        ]
+        self.assertEqual(core.plan_palette(color_sets), [red, blue, green])
+
+    def test_lzw_code_size_covers_only_colors_in_frame(self):
+        palette = [bytes(bytearray([i, 0, 0])) for i in range(16)]
+        image = [[palette[0], palette[1]], [palette[1], palette[0]]]
+        self.assertEqual(core._get_image_data(image, palette)[:1], b'\x02')
+        image[0][0] = palette[15]
+        self.assertEqual(core._get_image_data(image, palette)[:1], b'\x04')
+
+    def test_palette_report(self):
+        mask = np.zeros((3, 16, 16), dtype='uint8')
+        mask[:, 4:12, 4:12] = 255
+        shades = np.arange(0, 256, 17).repeat(16).reshape(16, 16)
+        gradient = np.array([shades, shades, shades])
+        report = core.get_palette_report([mask, mask, gradient])
+        self.assertEqual(report['colors'], 16)
+        self.assertEqual(report['lzw_code_sizes'], [2, 2, 4])
+        self.assertEqual(report['baseline_lzw_code_size'], 4)
+        self.assertEqual(report['color_table_bytes'], 48)
+        self.assertLess(
+            report['image_data_bytes'], report['baseline_image_data_bytes'])
+
+    def test_plan_palette_error_when_more_than_256_colors(self):
+        color_sets = [
+            Counter(dict((bytes(bytearray([i, 0, 0])), 1)
+                         for i in range(200))),
+            Counter(dict((bytes(bytearray([0, i, 0])), 1)
+                         for i in range(1, 200))),
+        ]
+        with self.assertRaises(RuntimeError):
+            core.plan_palette(color_sets)
+
+    def test_palette_report_error_when_more_than_256_colors(self):
+        x = np.arange(200).reshape(1, 200)
+        z = np.zeros((1, 200))
+        with self.assertRaises(RuntimeError):
+            core.get_palette_report([np.array([x, z, z]), np.array([z, x, z])])
+
     def test_get_colors(self):
         colors = core.get_colors(self.flickinger_image)
         self.assertEqual(
@@ -194,6 +322,49 @@ class Array2GIFTestCase(unittest.TestCase):
             )
         )
 
+    @unittest.skipIf(tracemalloc is None, 'requires tracemalloc')
+    def test_write_gif_peak_memory_independent_of_frame_count(self):
+        rng = np.random.RandomState(0)
+        frames = [
+            rng.randint(0, 4, size=(3, 60, 60)) * 60 for _ in range(8)]
+        peaks = []
+        for num_frames in (4, 8):
+            tracemalloc.start()
+            try:
+                core.write_gif(frames[:num_frames], self.filename)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            peaks.append(peak)
+        # Keeping even one byte per pixel of the 4 extra frames would
+        # add 14,400 bytes.
+        self.assertLess(peaks[1] - peaks[0], 7200)
+
+    def test_get_dataset_colors_matches_get_colors(self):
+        colors = core.get_dataset_colors(self.flickinger_dataset)
+        self.assertEqual(colors, core.get_colors(self.flickinger_image))
+        self.assertEqual(
+            colors.most_common(),
+            core.get_colors(self.flickinger_image).most_common()
+        )
+
+    def test_get_dataset_colors_error_when_more_than_256_colors(self):
+        x = np.array(range(100))
+        z = np.zeros(len(x))
+        d = np.array([[x, z, z], [z, x, z], [z, z, x]])
+        with self.assertRaises(RuntimeError):
+            core.get_dataset_colors(d)
+
+    def test_get_indices(self):
+        colors = core.get_colors(self.flickinger_image)
+        indices = core.get_indices(self.flickinger_dataset, colors)
+        palette = core.get_palette(colors)
+        self.assertEqual(indices.dtype, np.uint8)
+        self.assertEqual(
+            [[palette[i] for i in row] for row in indices],
+            self.flickinger_image
+        )
+
     def test_logical_screen_descriptor(self):
         colors = core.get_colors(self.flickinger_image)
         self.assertEqual(
@@ -248,6 +419,270 @@ class Array2GIFTestCase(unittest.TestCase):
             b'\xfa\xa8\xde`\x8c\x04\x91L\x01\x00;'
         )
 
+    def test_write_animated_gif_with_durations_and_loop(self):
+        dataset = self.flickinger_dataset
+        core.write_gif(
+            [dataset, dataset], self.filename, durations=[0.25, 1.5], loop=2)
+        with open(self.filename, 'rb') as infile:
+            gif = infile.read()
+        self.assertIn(b'NETSCAPE2.0\x03\x01\x02\x00\x00', gif)
+        self.assertIn(b'!\xf9\x04\x04\x19\x00\x00\x00', gif)
+        self.assertIn(b'!\xf9\x04\x04\x96\x00\x00\x00', gif)
+
+    def test_write_animated_gif_play_once(self):
+        dataset = self.flickinger_dataset
+        core.write_gif([dataset, dataset], self.filename, loop=None)
+        with open(self.filename, 'rb') as infile:
+            gif = infile.read()
+        self.assertNotIn(b'NETSCAPE2.0', gif)
+
+    def test_frame_key_depends_on_pixels_palette_and_delay(self):
+        image = self.flickinger_image
+        colors = core.get_colors(image)
+        key = core.get_frame_key(image, colors)
+        self.assertEqual(key, core.get_frame_key(image, colors))
+        self.assertNotEqual(
+            key, core.get_frame_key(image, colors, delay_time=10))
+        other_image = core.get_image(self.flickinger_dataset[::-1])
+        self.assertNotEqual(key, core.get_frame_key(other_image, colors))
+        other_colors = colors.copy()
+        other_colors[b'\x01\x02\x03'] = 1
+        self.assertNotEqual(key, core.get_frame_key(image, other_colors))
+
+    def test_write_gif_with_cache_skips_encoding(self):
+        dataset = self.flickinger_dataset
+        reversed_dataset = np.array([dataset[2], dataset[1], dataset[0]])
+        datasets = [dataset, reversed_dataset, dataset]
+        core.write_gif(datasets, self.filename)
+        with open(self.filename, 'rb') as infile:
+            expected = infile.read()
+        frame_cache = cache.MemoryCache()
+        get_sub_image = core._get_sub_image
+        calls = []
+
+        def counting_get_sub_image(*args, **kwargs):
+            calls.append(args)
+            return get_sub_image(*args, **kwargs)
+
+        core._get_sub_image = counting_get_sub_image
+        try:
+            for _ in range(2):
+                core.write_gif(datasets, self.filename, cache=frame_cache)
+                with open(self.filename, 'rb') as infile:
+                    self.assertEqual(infile.read(), expected)
+        finally:
+            core._get_sub_image = get_sub_image
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(frame_cache), 2)
+
+    def test_scale_factor(self):
+        self.assertEqual(core.get_scale_factor(10, 10), 1)
+        self.assertEqual(core.get_scale_factor(10, 10, scale=2), 2)
+        self.assertEqual(core.get_scale_factor(10, 250, max_size=100), 3)
+        self.assertEqual(
+            core.get_scale_factor(10, 250, scale=4, max_size=100), 4)
+        with self.assertRaises(ValueError):
+            core.get_scale_factor(10, 10, scale=1.5)
+        with self.assertRaises(ValueError):
+            core.get_scale_factor(10, 10, max_size=0)
+
+    def test_downscale_nearest(self):
+        d = core.downscale_dataset(self.flickinger_dataset, scale=5)
+        self.assertEqual(d.shape, (3, 2, 2))
+        expected = self.flickinger_dataset[:, ::5, ::5]
+        self.assertEqual(True, (d == expected).all())
+
+    def test_downscale_mean_with_partial_blocks(self):
+        d = np.array([
+            [[0, 2, 4], [2, 4, 6], [8, 8, 8]],
+            [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
+            [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+        ])
+        small = core.downscale_dataset(d, scale=2, resample='mean')
+        self.assertEqual(small.shape, (3, 2, 2))
+        self.assertEqual(small[0].tolist(), [[2, 5], [8, 8]])
+        self.assertEqual(small[2].tolist(), [[1, 1], [1, 1]])
+
+    def test_downscale_PIL_format_and_animations(self):
+        pil_d = self.flickinger_dataset.transpose((1, 2, 0))
+        self.assertEqual(
+            core.downscale_dataset(pil_d, max_size=4).shape, (4, 4, 3))
+        four_d = np.array([self.flickinger_dataset] * 2)
+        self.assertEqual(
+            core.downscale_dataset(four_d, scale=2).shape, (2, 3, 5, 5))
+        as_list = core.downscale_dataset(list(four_d), scale=2)
+        self.assertEqual([d.shape for d in as_list], [(3, 5, 5)] * 2)
+
+    def test_write_gif_with_max_size(self):
+        core.write_gif(self.flickinger_dataset, self.filename, max_size=5)
+        with open(self.filename, 'rb') as infile:
+            gif = infile.read()
+        self.assertEqual(gif[6:10], b'\x05\x00\x05\x00')
+
+
+class FrameEncoderTestCase(unittest.TestCase):
+    """LZW encoder buffer reuse and memory test cases."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Enough codes to fill the code table (and reset it) twice.
+        rng = np.random.RandomState(0)
+        cls.palette = [bytes(bytearray([i, 0, 0])) for i in range(256)]
+        cls.indices = rng.randint(0, 256, size=(100, 100)).astype('uint8')
+        cls.image = [[cls.palette[i] for i in row] for row in cls.indices]
+
+    def test_buffers_reused_across_frames(self):
+        encoder = core.FrameEncoder()
+        first = encoder.encode(self.image, self.palette)
+        indices, output = encoder._indices, encoder._output
+        small_image = [row[:10] for row in self.image[:10]]
+        encoder.encode(small_image, self.palette)
+        self.assertEqual(encoder.encode(self.image, self.palette), first)
+        self.assertIs(encoder._indices, indices)
+        self.assertIs(encoder._output, output)
+
+    def test_encode_indices_same_as_image(self):
+        encoder = core.FrameEncoder()
+        self.assertEqual(
+            encoder.encode(self.indices, self.palette),
+            encoder.encode(self.image, self.palette)
+        )
+
+    def test_output_within_max_output_size(self):
+        num_pixels = len(self.image) * len(self.image[0])
+        data = core.FrameEncoder().encode(self.image, self.palette)
+        self.assertLessEqual(
+            len(data), core.FrameEncoder.max_output_size(num_pixels))
+
+    @unittest.skipIf(tracemalloc is None, 'requires tracemalloc')
+    def test_peak_memory_bounded_by_frame_size(self):
+        rng = np.random.RandomState(1)
+        small = rng.randint(0, 256, size=(80, 80)).astype('uint8')
+        large = rng.randint(0, 256, size=(160, 160)).astype('uint8')
+        encoder = core.FrameEncoder()
+        encoder.encode(large, self.palette)  # size the buffers
+        peaks = []
+        for indices in (small, large):
+            tracemalloc.start()
+            try:
+                encoder.encode(indices, self.palette)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            peaks.append(peak)
+        # Both frames fill the code table, so the small frame's peak is
+        # the fixed allowance for it. Past that, the large frame may only
+        # use half a byte per pixel; even one more copy of its color
+        # indices would take a whole byte per pixel.
+        table_allowance = peaks[0]
+        self.assertLess(peaks[1], table_allowance + large.size // 2)
+
+
+class CacheTestCase(unittest.TestCase):
+    """Encoded frame cache test cases."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_lru_eviction(self, frame_cache):
+        frame_cache.set('a', b'1' * 4)
+        frame_cache.set('b', b'2' * 4)
+        self.assertEqual(frame_cache.get('a'), b'1' * 4)
+        frame_cache.set('c', b'3' * 4)
+        self.assertIsNone(frame_cache.get('b'))
+        self.assertEqual(frame_cache.get('a'), b'1' * 4)
+        self.assertEqual(frame_cache.get('c'), b'3' * 4)
+        self.assertEqual(frame_cache.size, 8)
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        self.check_lru_eviction(cache.MemoryCache(max_bytes=10))
+
+    def test_directory_cache_evicts_least_recently_used(self):
+        frame_cache = cache.DirectoryCache(self.path, max_bytes=8)
+        frame_cache.set('a', b'1' * 3)
+        frame_cache.set('b', b'2' * 3)
+        # File times may be coarse, so age the entries explicitly.
+        os.utime(frame_cache._filename('a'), (1, 1))
+        os.utime(frame_cache._filename('b'), (2, 2))
+        self.assertEqual(frame_cache.get('a'), b'1' * 3)
+        frame_cache.set('c', b'3' * 3)
+        self.assertIsNone(frame_cache.get('b'))
+        self.assertEqual(frame_cache.get('a'), b'1' * 3)
+        self.assertEqual(frame_cache.get('c'), b'3' * 3)
+        self.assertEqual(frame_cache.size, 6)
+
+    def test_directory_cache_scans_only_when_over_budget(self):
+        frame_cache = cache.DirectoryCache(self.path, max_bytes=100)
+        listdir = cache.os.listdir
+        calls = []
+
+        def counting_listdir(path):
+            calls.append(path)
+            return listdir(path)
+
+        cache.os.listdir = counting_listdir
+        try:
+            for key in 'abcdefghij':
+                frame_cache.set(key, b'x' * 10)
+            self.assertEqual(len(calls), 1)  # the initial size
+            frame_cache.set('k', b'x' * 10)
+            self.assertEqual(len(calls), 2)  # evicting
+        finally:
+            cache.os.listdir = listdir
+        self.assertLessEqual(frame_cache.size, 75)
+        self.assertEqual(frame_cache.get('k'), b'x' * 10)
+
+    def test_directory_cache_removes_temporary_file_on_failure(self):
+        frame_cache = cache.DirectoryCache(self.path)
+        with self.assertRaises(TypeError):
+            frame_cache.set('a', [1, 2, 3])  # not bytes
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_directory_cache_persists_between_instances(self):
+        cache.DirectoryCache(self.path).set('a', b'frame')
+        self.assertEqual(cache.DirectoryCache(self.path).get('a'), b'frame')
+
+    def test_directory_cache_set_tolerates_other_processes(self):
+        frame_cache = cache.DirectoryCache(self.path)
+        frame_cache.set('a', b'old frame')
+        getsize = cache.os.path.getsize
+
+        def getsize_after_removal(filename):
+            os.remove(filename)  # as if evicted by another process
+            return getsize(filename)
+
+        cache.os.path.getsize = getsize_after_removal
+        try:
+            frame_cache.set('a', b'new frame')
+        finally:
+            cache.os.path.getsize = getsize
+        self.assertEqual(frame_cache.get('a'), b'new frame')
+
+    def test_directory_cache_set_failure_skips_frame(self):
+        frame_cache = cache.DirectoryCache(self.path)
+        rename = cache.os.rename
+
+        def failing_rename(source, destination):
+            raise OSError('no space left on device')
+
+        cache.os.rename = failing_rename
+        try:
+            frame_cache.set('a', b'frame')
+        finally:
+            cache.os.rename = rename
+        self.assertIsNone(frame_cache.get('a'))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_cache_ignores_values_larger_than_max_bytes(self):
+        for frame_cache in (cache.MemoryCache(max_bytes=2),
+                            cache.DirectoryCache(self.path, max_bytes=2)):
+            frame_cache.set('a', b'too big')
+            self.assertIsNone(frame_cache.get('a'))
+            self.assertEqual(len(frame_cache), 0)
+
 
 if __name__ == '__main__':
     unittest.main()